@@ -2,12 +2,16 @@
 ProtAtlasViz - Protein Atlas Tissue Expression Visualizer
 A Dash application for visualizing tissue-selective gene expression patterns
 """
+import json
+from concurrent.futures import ThreadPoolExecutor
 import dash
 from dash import dcc, html, Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
+from flask_caching import Cache
 import plotly.graph_objects as go
+import plotly.io as pio
 import plotly.express as px
-import pandas as pd
 import numpy as np
 from data_loader import DataLoader
 
@@ -15,12 +19,20 @@ from data_loader import DataLoader
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 app.title = "ProtAtlasViz - Gene Expression Visualizer"
 
+# Figures are a pure function of the selections, so cache their JSON in memory
+cache = Cache(app.server, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 3600})
+
 # Initialize data loader
 data_loader = DataLoader()
-print("Loading expression data...")
-data_loader.load_expression_data()
-print("Loading histology dictionary...")
-data_loader.load_histology_dictionary()
+print("Loading expression data and histology dictionary...")
+# The two inputs are independent, so read them concurrently
+with ThreadPoolExecutor(max_workers=2) as executor:
+    expression_future = executor.submit(data_loader.load_expression_data)
+    histology_future = executor.submit(data_loader.load_histology_dictionary)
+    expression_future.result()
+    histology_future.result()
+print("Building tissue indices...")
+data_loader.build_derived_indices()
 print(f"Data loaded: {len(data_loader.genes)} genes available")
 
 # Layout
@@ -42,7 +54,7 @@ app.layout = dbc.Container([
                            className="text-muted small"),
                     dcc.Dropdown(
                         id='gene-selector',
-                        options=[{'label': gene, 'value': gene} for gene in data_loader.genes],
+                        options=[],  # Filled from the server as the user types
                         multi=True,
                         placeholder="Type to search genes...",
                         searchable=True,
@@ -119,33 +131,31 @@ app.layout = dbc.Container([
 ], fluid=True, style={'maxWidth': '1400px'})
 
 
-def create_heatmap(data: pd.DataFrame, ordered_tissues: list, tissue_to_group: dict, 
-                   show_groups: bool = True, log_scale: bool = False) -> go.Figure:
-    """Create a heatmap visualization"""
-    # Pivot data for heatmap
-    pivot_data = data.pivot(index='Gene name', columns='Tissue', values='nTPM')
-    
-    # Reorder columns to match tissue order
-    available_tissues = [t for t in ordered_tissues if t in pivot_data.columns]
-    pivot_data = pivot_data[available_tissues]
+def build_hover_data(groups, value_strs: np.ndarray) -> np.ndarray:
+    """
+    Build per-point customdata for hover templates
+    Returns an array of shape value_strs.shape: organ group, then the preformatted values
+    """
+    groups = np.broadcast_to(np.asarray(groups, dtype=object), value_strs.shape[:-1])
+    return np.concatenate([groups[..., None], value_strs], axis=-1)
+
+
+def hover_template(gene: str, tissue: str, log_scale: bool = False) -> str:
+    """Hover template reading organ group and values from build_hover_data customdata"""
+    template = f"Gene: {gene}<br>Tissue: {tissue}<br>Organ: %{{customdata[0]}}"
+    if log_scale:
+        template += "<br>log2(nTPM+1): %{customdata[1]}<br>nTPM: %{customdata[2]}"
+    else:
+        template += "<br>nTPM: %{customdata[1]}"
     
-    # Create custom hover text
-    hover_text = []
-    for gene in pivot_data.index:
-        row_text = []
-        for tissue in pivot_data.columns:
-            value = pivot_data.loc[gene, tissue]
-            if pd.isna(value):
-                row_text.append(f"Gene: {gene}<br>Tissue: {tissue}<br>nTPM: N/A")
-            else:
-                group = tissue_to_group.get(tissue, "Other")
-                if log_scale:
-                    # Show both log and original value
-                    original_value = 2**value - 1
-                    row_text.append(f"Gene: {gene}<br>Tissue: {tissue}<br>Organ: {group}<br>log2(nTPM+1): {value:.2f}<br>nTPM: {original_value:.1f}")
-                else:
-                    row_text.append(f"Gene: {gene}<br>Tissue: {tissue}<br>Organ: {group}<br>nTPM: {value:.1f}")
-        hover_text.append(row_text)
+    return template + "<extra></extra>"
+
+
+def create_heatmap(values: np.ndarray, value_strs: np.ndarray, genes: list, tissues: list, groups, 
+                   show_groups: bool = True, log_scale: bool = False) -> go.Figure:
+    """Create a heatmap visualization from a (genes x tissues) expression matrix"""
+    # Gene and tissue come from the axes, so customdata only carries group and values
+    hover_data = build_hover_data(groups, value_strs)
     
     # Improve color contrast with multi-step colorscale
     colorscale = [
@@ -158,26 +168,30 @@ def create_heatmap(data: pd.DataFrame, ordered_tissues: list, tissue_to_group: d
     ]
     
     fig = go.Figure(data=go.Heatmap(
-        z=pivot_data.values,
-        x=pivot_data.columns,
-        y=pivot_data.index,
+        z=values,
+        x=tissues,
+        y=genes,
         colorscale=colorscale,
-        hovertemplate='%{customdata}<extra></extra>',
-        customdata=hover_text,
+        hovertemplate=hover_template('%{y}', '%{x}', log_scale=log_scale),
+        customdata=hover_data,
         colorbar=dict(title="log2(nTPM+1)" if log_scale else "nTPM")
     ))
     
-    # Add group separators if showing individual tissues
+    # Add group separators if showing individual tissues; the shapes are set
+    # in one layout update rather than validated one add_vline call at a time
     if show_groups:
+        separators = []
         current_group = None
-        for i, tissue in enumerate(pivot_data.columns):
-            group = tissue_to_group.get(tissue, "Other")
+        for i, group in enumerate(groups):
             if group != current_group:
-                fig.add_vline(x=i-0.5, line_width=2, line_color="white")
+                separators.append(dict(type='line', x0=i-0.5, x1=i-0.5, xref='x',
+                                       y0=0, y1=1, yref='y domain',
+                                       line=dict(width=2, color='white')))
                 current_group = group
+        fig.update_layout(shapes=separators)
     
     # Calculate dynamic width based on number of tissues (minimum 800, maximum 2000)
-    num_tissues = len(pivot_data.columns)
+    num_tissues = len(tissues)
     dynamic_width = max(800, min(2000, num_tissues * 25 + 200))
     
     fig.update_layout(
@@ -187,7 +201,7 @@ def create_heatmap(data: pd.DataFrame, ordered_tissues: list, tissue_to_group: d
         },
         xaxis_title="Tissue",
         yaxis_title="Gene",
-        height=max(600, len(pivot_data.index) * 60),
+        height=max(600, len(genes) * 60),
         width=dynamic_width,
         xaxis={
             'tickangle': -45,
@@ -206,42 +220,26 @@ def create_heatmap(data: pd.DataFrame, ordered_tissues: list, tissue_to_group: d
     return fig
 
 
-def create_bar_chart(data: pd.DataFrame, ordered_tissues: list, tissue_to_group: dict, 
+def create_bar_chart(values: np.ndarray, value_strs: np.ndarray, genes: list, tissues: list, groups,
                      log_scale: bool = False) -> go.Figure:
-    """Create a grouped bar chart"""
-    # Ensure proper ordering
-    data = data.copy()
-    data['Tissue'] = pd.Categorical(data['Tissue'], categories=ordered_tissues, ordered=True)
-    data = data.sort_values('Tissue')
+    """Create a grouped bar chart from a (genes x tissues) expression matrix"""
+    hover_data = build_hover_data(groups, value_strs)
     
     fig = go.Figure()
     
-    for gene in data['Gene name'].unique():
-        gene_data = data[data['Gene name'] == gene]
-        
-        if log_scale:
-            hover_text = [
-                f"Gene: {gene}<br>Tissue: {tissue}<br>Organ: {tissue_to_group.get(tissue, 'Other')}<br>log2(nTPM+1): {ntpm:.2f}<br>nTPM: {(2**ntpm - 1):.1f}"
-                for tissue, ntpm in zip(gene_data['Tissue'], gene_data['nTPM'])
-            ]
-        else:
-            hover_text = [
-                f"Gene: {gene}<br>Tissue: {tissue}<br>Organ: {tissue_to_group.get(tissue, 'Other')}<br>nTPM: {ntpm:.1f}"
-                for tissue, ntpm in zip(gene_data['Tissue'], gene_data['nTPM'])
-            ]
-        
+    for i, gene in enumerate(genes):
         fig.add_trace(go.Bar(
             name=gene,
-            x=gene_data['Tissue'],
-            y=gene_data['nTPM'],
-            hovertemplate='%{customdata}<extra></extra>',
-            customdata=hover_text
+            x=tissues,
+            y=values[i],
+            hovertemplate=hover_template(gene, '%{x}', log_scale=log_scale),
+            customdata=hover_data[i]
         ))
     
     yaxis_title = "log2(nTPM+1)" if log_scale else "nTPM"
     
     # Calculate dynamic width based on number of tissues (minimum 800, maximum 2000)
-    num_tissues = len(data['Tissue'].unique())
+    num_tissues = len(tissues)
     dynamic_width = max(800, min(2000, num_tissues * 25 + 200))
     
     fig.update_layout(
@@ -284,30 +282,23 @@ def create_bar_chart(data: pd.DataFrame, ordered_tissues: list, tissue_to_group:
     return fig
 
 
-def create_box_plot(data: pd.DataFrame, ordered_tissues: list, tissue_to_group: dict,
+def create_box_plot(values: np.ndarray, genes: list, tissues: list,
                     log_scale: bool = False) -> go.Figure:
     """Create a box plot showing expression distribution"""
-    # Ensure proper ordering
-    data = data.copy()
-    data['Tissue'] = pd.Categorical(data['Tissue'], categories=ordered_tissues, ordered=True)
-    data = data.sort_values('Tissue')
-    
     fig = go.Figure()
     
-    for gene in data['Gene name'].unique():
-        gene_data = data[data['Gene name'] == gene]
-        
+    for i, gene in enumerate(genes):
         fig.add_trace(go.Box(
             name=gene,
-            x=gene_data['Tissue'],
-            y=gene_data['nTPM'],
+            x=tissues,
+            y=values[i],
             boxmean='sd'
         ))
     
     yaxis_title = "log2(nTPM+1)" if log_scale else "nTPM"
     
     # Calculate dynamic width based on number of tissues (minimum 800, maximum 2000)
-    num_tissues = len(data['Tissue'].unique())
+    num_tissues = len(tissues)
     dynamic_width = max(800, min(2000, num_tissues * 25 + 200))
     
     fig.update_layout(
@@ -349,6 +340,23 @@ def create_box_plot(data: pd.DataFrame, ordered_tissues: list, tissue_to_group:
     return fig
 
 
+@app.callback(
+    Output('gene-selector', 'options'),
+    Input('gene-selector', 'search_value'),
+    State('gene-selector', 'value')
+)
+def update_gene_options(search_value, selected_genes):
+    """Search genes on the server instead of shipping all ~20k options to the browser"""
+    if not search_value:
+        raise PreventUpdate
+    
+    # Selected genes must stay in the options or the dropdown drops them
+    selected_genes = selected_genes or []
+    matches = data_loader.search_genes(search_value)
+    genes = matches + [gene for gene in selected_genes if gene not in matches]
+    return [{'label': gene, 'value': gene} for gene in genes]
+
+
 @app.callback(
     Output('gene-count', 'children'),
     Input('gene-selector', 'value')
@@ -366,6 +374,37 @@ def update_gene_count(selected_genes):
         return f"✓ {count}/10 genes selected"
 
 
+@cache.memoize()
+def build_figure_json(genes: tuple, grouping: str, viz_type: str, log_scale: str):
+    """Build the figure for a selection and return its Plotly JSON (None if no data)"""
+    # Gather straight from the precomputed gene x tissue (or organ group) matrix
+    if grouping == 'organ':
+        gene_names, tissues, values, value_strs = data_loader.get_organ_matrix(
+            list(genes), log_scale=(log_scale == 'log'))
+        groups = tissues  # Groups map to themselves
+    else:
+        gene_names, tissues, values, value_strs = data_loader.get_expression_matrix(
+            list(genes), log_scale=(log_scale == 'log'))
+        groups = data_loader.get_tissue_groups(tissues)
+    
+    if not gene_names:
+        return None
+    
+    # Create appropriate visualization
+    if viz_type == 'heatmap':
+        fig = create_heatmap(values, value_strs, gene_names, tissues, groups, 
+                            show_groups=(grouping == 'tissue'), log_scale=(log_scale == 'log'))
+    elif viz_type == 'bar':
+        fig = create_bar_chart(values, value_strs, gene_names, tissues, groups, 
+                              log_scale=(log_scale == 'log'))
+    else:  # 'box', the callback rejects any other type before calling us
+        fig = create_box_plot(values, gene_names, tissues,
+                             log_scale=(log_scale == 'log'))
+    
+    # The figure was validated while it was built; skip the second pass on serialization
+    return pio.to_json(fig, validate=False)
+
+
 @app.callback(
     Output('visualization-container', 'children'),
     [Input('gene-selector', 'value'),
@@ -389,46 +428,21 @@ def update_visualization(selected_genes, grouping, viz_type, log_scale):
             className="text-center"
         )
     
-    # Get expression data for selected genes
-    expression_data = data_loader.get_expression_for_genes(selected_genes)
+    if viz_type not in ('heatmap', 'bar', 'box'):
+        return dbc.Alert("Invalid visualization type", color="danger")
+    
+    # Sort genes so every ordering of the same selection shares one cache entry
+    figure_json = build_figure_json(tuple(sorted(selected_genes)), grouping, viz_type, log_scale)
     
-    if expression_data.empty:
+    if figure_json is None:
         return dbc.Alert(
             "No expression data found for selected genes",
             color="warning",
             className="text-center"
         )
     
-    # Get ordered tissues and grouping information
-    ordered_tissues, tissue_to_group = data_loader.get_ordered_tissues_by_group()
-    
-    # Aggregate by organ group if requested
-    if grouping == 'organ':
-        expression_data = data_loader.aggregate_by_organ_group(expression_data)
-        # Update ordered list for organ groups
-        ordered_tissues = sorted(expression_data['Tissue'].unique())
-        tissue_to_group = {t: t for t in ordered_tissues}  # Groups map to themselves
-    
-    # Apply log transformation if requested
-    if log_scale == 'log':
-        expression_data = expression_data.copy()
-        expression_data['nTPM'] = np.log2(expression_data['nTPM'] + 1)  # log2(x+1) to handle zeros
-    
-    # Create appropriate visualization
-    if viz_type == 'heatmap':
-        fig = create_heatmap(expression_data, ordered_tissues, tissue_to_group, 
-                            show_groups=(grouping == 'tissue'), log_scale=(log_scale == 'log'))
-    elif viz_type == 'bar':
-        fig = create_bar_chart(expression_data, ordered_tissues, tissue_to_group, 
-                              log_scale=(log_scale == 'log'))
-    elif viz_type == 'box':
-        fig = create_box_plot(expression_data, ordered_tissues, tissue_to_group,
-                             log_scale=(log_scale == 'log'))
-    else:
-        return dbc.Alert("Invalid visualization type", color="danger")
-    
     return dcc.Graph(
-        figure=fig,
+        figure=json.loads(figure_json),
         config={
             'displayModeBar': True,
             'displaylogo': False,
@@ -2,8 +2,19 @@
 Data loading and processing module for ProtAtlasViz
 Handles loading RNA tissue consensus data and histology dictionary
 """
+import os
+import numpy as np
 import pandas as pd
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional; fall back to the pandas CSV parser
+    pa = pa_csv = pq = None
+
+EXPRESSION_COLUMNS = ['Gene', 'Gene name', 'Tissue', 'nTPM']
 
 
 class DataLoader:
@@ -15,15 +26,91 @@ class DataLoader:
         self.histology_path = histology_path
         self.expression_data = None
         self.tissue_groups = None
+        self.tissue_to_group = None
+        self.ordered_tissues = None
+        self.group_by_tissue_code = None
+        self._tissue_order = None
+        self._ordered_tissue_idx = None
         self.genes = None
+        self.genes_lower = None
+        self._by_gene = None
+        self.matrix = None
+        self.gene_to_row = None
+        self.tissue_to_col = None
+        self.nan_mask = None
+        self.organ_matrix = None
+        self.organ_nan_mask = None
+        self._canonical = None
         
     def load_expression_data(self) -> pd.DataFrame:
         """Load RNA tissue consensus data"""
-        self.expression_data = pd.read_csv(self.data_path, sep='\t')
-        # Get unique genes for autocomplete
-        self.genes = sorted(self.expression_data['Gene name'].unique())
+        self.expression_data = self._read_expression_table()
+        # Gene and tissue names repeat across ~1M rows; integer codes make
+        # groupby/isin/unique work on small arrays instead of strings
+        for column in ('Gene name', 'Tissue'):
+            names = self.expression_data[column].astype('category')
+            # Casting strings yields sorted categories, but an already categorical
+            # column keeps its own order; codes, matrix rows and the gene list all
+            # rely on alphabetical order
+            if not names.cat.categories.is_monotonic_increasing:
+                names = names.cat.reorder_categories(names.cat.categories.sort_values())
+            self.expression_data[column] = names
+        # nTPM needs nowhere near float64 precision; float32 halves memory traffic
+        # (no-op unless an older Parquet cache stored float64)
+        self.expression_data['nTPM'] = self.expression_data['nTPM'].astype(np.float32)
+        # Case-insensitive lookup of the tissue names used in the data
+        self._canonical = {t.lower(): t for t in self.expression_data['Tissue'].cat.categories}
+        # Get unique genes for autocomplete straight from the sorted categories
+        self.genes = self.expression_data['Gene name'].cat.categories.tolist()
+        self.genes_lower = np.char.lower(np.array(self.genes, dtype=str))
+        # Row index by gene is built on the first get_expression_for_genes call
+        self._by_gene = None
+        # Dense gene x tissue matrix for heatmaps; gene names shared by several
+        # Ensembl IDs are averaged so every (gene, tissue) cell is unique, and
+        # tissues a gene was not measured in are NaN
+        self.matrix = self.expression_data.pivot_table(
+            index='Gene name', columns='Tissue', values='nTPM', aggfunc='mean',
+            fill_value=np.nan, observed=True
+        ).astype(np.float32)
+        self.nan_mask = np.isnan(self.matrix.to_numpy())
+        self.gene_to_row = {gene: i for i, gene in enumerate(self.matrix.index)}
+        self.tissue_to_col = {tissue: j for j, tissue in enumerate(self.matrix.columns)}
         return self.expression_data
     
+    def _read_expression_table(self) -> pd.DataFrame:
+        """Read the expression TSV, through a Parquet cache when pyarrow is available"""
+        if pq is None:
+            return pd.read_csv(self.data_path, sep='\t', dtype={'nTPM': np.float32})
+        
+        try:
+            cache_path = self._ensure_parquet_cache()
+            return pq.read_table(cache_path, columns=EXPRESSION_COLUMNS).to_pandas()
+        except (OSError, pa.ArrowInvalid):
+            # The cache is only an optimisation: an unwritable directory or an
+            # unreadable cache file falls back to parsing the TSV
+            return pd.read_csv(self.data_path, sep='\t', dtype={'nTPM': np.float32})
+    
+    def _ensure_parquet_cache(self) -> str:
+        """Write a Parquet copy of the TSV on first run (or when the TSV is newer)"""
+        cache_path = os.path.splitext(self.data_path)[0] + '.parquet'
+        if (not os.path.exists(cache_path)
+                or os.path.getmtime(cache_path) < os.path.getmtime(self.data_path)):
+            table = pa_csv.read_csv(
+                self.data_path,
+                parse_options=pa_csv.ParseOptions(delimiter='\t'),
+                convert_options=pa_csv.ConvertOptions(column_types={'nTPM': pa.float32()}),
+            )
+            # Write next to the cache and swap it in, so an interrupted run or a
+            # concurrent worker never leaves a partial file at cache_path
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            try:
+                pq.write_table(table, tmp_path)
+                os.replace(tmp_path, cache_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return cache_path
+    
     def load_histology_dictionary(self) -> Dict[str, List[str]]:
         """Parse histology dictionary to create organ -> tissues mapping"""
         tissue_groups = {}
@@ -45,85 +132,198 @@ class DataLoader:
         self.tissue_groups = tissue_groups
         return tissue_groups
     
-    def get_tissue_to_group_mapping(self) -> Dict[str, str]:
-        """Create reverse mapping: tissue -> organ group (case-insensitive)"""
-        if self.tissue_groups is None:
-            self.load_histology_dictionary()
-        
-        if self.expression_data is None:
-            self.load_expression_data()
-        
+    def build_derived_indices(self) -> None:
+        """
+        Precompute tissue ordering, tissue -> organ group mapping and organ-group means
+        Needs both the expression data and the histology dictionary; call it again
+        after reloading either one
+        """
         # Get all tissues from actual data
         all_tissues_in_data = self.expression_data['Tissue'].unique()
         
         tissue_to_group = {}
+        ordered_tissues = []
         for group, tissues in self.tissue_groups.items():
             for tissue in tissues:
-                # Find matching tissue in data (case-insensitive)
-                matching_tissues = [t for t in all_tissues_in_data 
-                                   if t.lower() == tissue.lower()]
-                if matching_tissues:
+                matching_tissue = self._canonical.get(tissue.lower())
+                if matching_tissue is not None:
                     # Map the actual tissue name from data to the group
-                    tissue_to_group[matching_tissues[0]] = group
+                    tissue_to_group[matching_tissue] = group
+                    ordered_tissues.append(matching_tissue)
+        
+        # Add any tissues not in dictionary at the end
+        for tissue in all_tissues_in_data:
+            if tissue not in tissue_to_group:
+                ordered_tissues.append(tissue)
+                tissue_to_group[tissue] = "Other"
+        
+        self.tissue_to_group = tissue_to_group
+        self.ordered_tissues = ordered_tissues
+        # Matrix columns in organ-group order, so the default gather needs no sort
+        self._tissue_order = {tissue: i for i, tissue in enumerate(ordered_tissues)}
+        order_key = self.matrix.columns.map(self._tissue_order).to_numpy()
+        self._ordered_tissue_idx = np.argsort(order_key, kind='stable')
+        # Organ group per Tissue category code; the trailing entry makes code -1
+        # (tissue not in the data) resolve to "Other"
+        tissue_categories = self.expression_data['Tissue'].cat.categories
+        self.group_by_tissue_code = np.array(
+            [tissue_to_group.get(t, "Other") for t in tissue_categories] + ["Other"], dtype=object
+        )
+        
+        # Mean nTPM per (gene, organ group); organ groupings are static, so this
+        # replaces the per-callback aggregation. Rows line up with self.matrix
+        gene_categories = self.expression_data['Gene name'].cat.categories
+        organ_groups, organ_of_tissue = np.unique(self.group_by_tissue_code[:-1].astype(str),
+                                                  return_inverse=True)
+        organ_means = self._mean_by_codes(
+            self.expression_data['Gene name'].cat.codes.to_numpy(),
+            organ_of_tissue[self.expression_data['Tissue'].cat.codes.to_numpy()],
+            self.expression_data['nTPM'].to_numpy(),
+            (len(gene_categories), len(organ_groups)),
+        )
+        self.organ_matrix = pd.DataFrame(
+            organ_means,
+            index=pd.CategoricalIndex(gene_categories, name='Gene name'),
+            columns=pd.Index(organ_groups, name='Organ Group'),
+        ).reindex(self.matrix.index)
+        self.organ_nan_mask = np.isnan(self.organ_matrix.to_numpy())
+    
+    @staticmethod
+    def _mean_by_codes(row_codes: np.ndarray, col_codes: np.ndarray, values: np.ndarray,
+                       shape: Tuple[int, int]) -> np.ndarray:
+        """
+        Mean of values per (row code, column code) cell as a float32 matrix
+        Sorts the flattened cell keys once and sums each run with np.add.reduceat;
+        cells without values are NaN
+        """
+        keys = row_codes.astype(np.int64) * shape[1] + col_codes
+        order = np.argsort(keys, kind='stable')
+        cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        sums = np.add.reduceat(values[order], starts, dtype=np.float64)
+        
+        means = np.full(shape[0] * shape[1], np.nan, dtype=np.float32)
+        means[cells] = sums / counts
+        return means.reshape(shape)
+    
+    @staticmethod
+    def _format_values(values: np.ndarray, nan_mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Format cells as nTPM and log2(nTPM+1) strings; missing cells read N/A"""
+        ntpm_strs = np.where(nan_mask, "N/A", np.char.mod("%.1f", values))
+        log_strs = np.where(nan_mask, "N/A", np.char.mod("%.2f", np.log2(values + 1)))
+        return ntpm_strs, log_strs
+    
+    def search_genes(self, query: str, limit: int = 50) -> List[str]:
+        """Get up to `limit` genes containing query (case-insensitive), prefix matches first"""
+        if self.genes_lower is None:
+            self.load_expression_data()
+        
+        positions = np.char.find(self.genes_lower, query.lower())
+        matches = np.concatenate([np.flatnonzero(positions == 0), np.flatnonzero(positions > 0)])
+        return [self.genes[i] for i in matches[:limit]]
+    
+    def get_tissue_to_group_mapping(self) -> Dict[str, str]:
+        """Get mapping: tissue -> organ group (case-insensitive)"""
+        if self.tissue_to_group is None:
+            self._ensure_tissue_index()
+        
+        return self.tissue_to_group
+    
+    def get_tissue_groups(self, tissues: List[str]) -> np.ndarray:
+        """Get the organ group of each tissue via its category code"""
+        if self.group_by_tissue_code is None:
+            self._ensure_tissue_index()
         
-        return tissue_to_group
+        tissue_codes = self.expression_data['Tissue'].cat.categories.get_indexer(tissues)
+        return self.group_by_tissue_code[tissue_codes]
     
     def get_expression_for_genes(self, gene_names: List[str]) -> pd.DataFrame:
         """Get expression data for selected genes"""
         if self.expression_data is None:
             self.load_expression_data()
         
-        filtered_data = self.expression_data[
-            self.expression_data['Gene name'].isin(gene_names)
-        ].copy()
+        if self._by_gene is None:
+            # Row positions per gene, so selections slice directly instead of scanning
+            self._by_gene = self.expression_data.groupby('Gene name', observed=True, sort=False).indices
+        
+        gene_rows = [self._by_gene[gene] for gene in gene_names if gene in self._by_gene]
+        if not gene_rows:
+            return self.expression_data.iloc[:0]
         
-        return filtered_data
+        return self.expression_data.iloc[np.concatenate(gene_rows)]
     
-    def get_ordered_tissues_by_group(self) -> Tuple[List[str], Dict[str, str]]:
+    def get_expression_matrix(self, gene_names: List[str], tissues: Optional[List[str]] = None,
+                              log_scale: bool = False) -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
         """
-        Get tissues ordered by organ group
-        Returns: (ordered_tissues, tissue_to_group_dict)
+        Get a (genes x tissues) nTPM matrix for selected genes
+        Genes keep the matrix (alphabetical) order, tissues follow the given order
+        (all tissues ordered by organ group by default)
+        Returns: (genes, tissues, values, value_strs), value_strs holding the
+        formatted hover values of each cell ([log2, nTPM] with log_scale)
         """
-        if self.tissue_groups is None:
-            self.load_histology_dictionary()
+        if tissues is None:
+            if self._ordered_tissue_idx is None:
+                self._ensure_tissue_index()
+            tissue_idx = self._ordered_tissue_idx
+        else:
+            if self.matrix is None:
+                self.load_expression_data()
+            tissue_idx = np.array([self.tissue_to_col[t] for t in tissues if t in self.tissue_to_col],
+                                  dtype=np.intp)
         
-        if self.expression_data is None:
-            self.load_expression_data()
-        
-        tissue_to_group = self.get_tissue_to_group_mapping()
-        
-        # Get all tissues from data that are in the dictionary
-        all_tissues_in_data = self.expression_data['Tissue'].unique()
+        return self._gather(self.matrix, self.nan_mask,
+                            gene_names, tissue_idx, log_scale)
+    
+    def get_organ_matrix(self, gene_names: List[str],
+                         log_scale: bool = False) -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
+        """
+        Get a (genes x organ groups) matrix of mean nTPM for selected genes
+        Returns: (genes, organ_groups, values, value_strs), as get_expression_matrix
+        """
+        if self.organ_matrix is None:
+            self._ensure_tissue_index()
         
-        # Order tissues by group
-        ordered_tissues = []
-        for group, tissues in self.tissue_groups.items():
-            for tissue in tissues:
-                # Normalize tissue names (case-insensitive matching)
-                matching_tissues = [t for t in all_tissues_in_data 
-                                   if t.lower() == tissue.lower()]
-                if matching_tissues:
-                    ordered_tissues.append(matching_tissues[0])
+        group_idx = np.arange(len(self.organ_matrix.columns))
+        return self._gather(self.organ_matrix, self.organ_nan_mask,
+                            gene_names, group_idx, log_scale)
+    
+    def _gather(self, matrix: pd.DataFrame, nan_mask: np.ndarray,
+                gene_names: List[str], column_idx: np.ndarray,
+                log_scale: bool) -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
+        """Gather selected genes (in matrix order) and columns from a precomputed matrix"""
+        gene_idx = np.sort(np.array([self.gene_to_row[g] for g in gene_names if g in self.gene_to_row],
+                                    dtype=np.intp))
+        cells = np.ix_(gene_idx, column_idx)
         
-        # Add any tissues not in dictionary at the end
-        for tissue in all_tissues_in_data:
-            if tissue not in ordered_tissues:
-                ordered_tissues.append(tissue)
-                tissue_to_group[tissue] = "Other"
+        values = matrix.to_numpy()[cells]
+        # Only the gathered cells are formatted, at most a few hundred per figure
+        ntpm_strs, log_strs = self._format_values(values, nan_mask[cells])
+        if log_scale:
+            np.log2(values + 1, out=values)  # log2(x+1) to handle zeros
+            # Show both log and original value
+            value_strs = np.stack([log_strs, ntpm_strs], axis=-1)
+        else:
+            value_strs = ntpm_strs[..., None]
         
-        return ordered_tissues, tissue_to_group
+        genes = matrix.index[gene_idx].tolist()
+        columns = matrix.columns[column_idx].tolist()
+        return genes, columns, values, value_strs
     
-    def aggregate_by_organ_group(self, data: pd.DataFrame) -> pd.DataFrame:
-        """Aggregate expression data by organ groups"""
-        tissue_to_group = self.get_tissue_to_group_mapping()
+    def get_ordered_tissues_by_group(self) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Get tissues ordered by organ group
+        Returns: (ordered_tissues, tissue_to_group_dict)
+        """
+        if self.ordered_tissues is None:
+            self._ensure_tissue_index()
         
-        # Add organ group column
-        data = data.copy()
-        data['Organ Group'] = data['Tissue'].map(tissue_to_group)
-        data['Organ Group'] = data['Organ Group'].fillna('Other')
+        return self.ordered_tissues, self.tissue_to_group
+    
+    def _ensure_tissue_index(self) -> None:
+        """Load whichever inputs are missing, then build the derived indices"""
+        if self.expression_data is None:
+            self.load_expression_data()
         
-        # Aggregate by gene and organ group (mean nTPM)
-        aggregated = data.groupby(['Gene', 'Gene name', 'Organ Group'])['nTPM'].mean().reset_index()
-        aggregated.rename(columns={'Organ Group': 'Tissue'}, inplace=True)
+        if self.tissue_groups is None:
+            self.load_histology_dictionary()
         
-        return aggregated
+        self.build_derived_indices()